@@ -1,6 +1,7 @@
 import os
 from dataclasses import dataclass
-from typing import List, Optional, Set
+from functools import lru_cache
+from typing import Callable, FrozenSet, List, Optional
 
 
 def _split_list(value: Optional[str]) -> List[str]:
@@ -9,13 +10,24 @@ def _split_list(value: Optional[str]) -> List[str]:
     return [item.strip() for item in value.split(",") if item.strip()]
 
 
+_TRUE_VALUES = frozenset(("1", "true", "yes", "on"))
+
+
 def _to_bool(value: Optional[str], default: bool = False) -> bool:
     if value is None:
         return default
-    return value.strip().lower() in {"1", "true", "yes", "on"}
+    return value.strip().lower() in _TRUE_VALUES
+
+
+def normalize_email(address: str) -> str:
+    # Домен регистронезависим, локальная часть по RFC 5321 — нет
+    local, sep, domain = address.rpartition("@")
+    if not sep:
+        return address
+    return f"{local}@{domain.lower()}"
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Settings:
     http_port: int
 
@@ -23,9 +35,11 @@ class Settings:
     attachments_subdir: str
     timezone: str
 
-    whitelist_emails: Set[str]
-    whitelist_tg_usernames: Set[str]
-    whitelist_tg_ids: Set[int]
+    whitelist_emails: FrozenSet[str]
+    # Связанный frozenset.__contains__: проверка уже нормализованного адреса
+    is_email_whitelisted: Callable[[str], bool]
+    whitelist_tg_usernames: FrozenSet[str]
+    whitelist_tg_ids: FrozenSet[int]
 
     telegram_bot_token: Optional[str]
     telegram_notify_chat_id: Optional[int]
@@ -39,6 +53,7 @@ class Settings:
     imap_poll_interval: int
 
 
+@lru_cache(maxsize=1)
 def load_settings() -> Settings:
     http_port = int(os.getenv("HTTP_PORT", "8080"))
 
@@ -46,15 +61,11 @@ def load_settings() -> Settings:
     attachments_subdir = os.getenv("ATTACHMENTS_SUBDIR", "attachments").strip()
     timezone = os.getenv("TIMEZONE", "Europe/Moscow").strip() or "Europe/Moscow"
 
-    whitelist_emails = {e.lower() for e in _split_list(os.getenv("WHITELIST_EMAILS"))}
-    whitelist_tg_usernames = {u.lower().lstrip("@") for u in _split_list(os.getenv("WHITELIST_TG_USERNAMES"))}
+    whitelist_emails = frozenset(normalize_email(e) for e in _split_list(os.getenv("WHITELIST_EMAILS")))
+    whitelist_tg_usernames = frozenset(u.lower().lstrip("@") for u in _split_list(os.getenv("WHITELIST_TG_USERNAMES")))
     whitelist_tg_ids_raw = _split_list(os.getenv("WHITELIST_TG_IDS"))
-    whitelist_tg_ids: Set[int] = set()
-    for item in whitelist_tg_ids_raw:
-        try:
-            whitelist_tg_ids.add(int(item))
-        except ValueError:
-            continue
+    # Некорректные ID молча пропускаем
+    whitelist_tg_ids = frozenset(int(x) for x in whitelist_tg_ids_raw if x.removeprefix("-").isdecimal())
 
     telegram_bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
     notify_chat = os.getenv("TELEGRAM_NOTIFY_CHAT_ID")
@@ -74,6 +85,7 @@ def load_settings() -> Settings:
         attachments_subdir=attachments_subdir,
         timezone=timezone,
         whitelist_emails=whitelist_emails,
+        is_email_whitelisted=whitelist_emails.__contains__,
         whitelist_tg_usernames=whitelist_tg_usernames,
         whitelist_tg_ids=whitelist_tg_ids,
         telegram_bot_token=telegram_bot_token,
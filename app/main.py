@@ -1,32 +1,66 @@
 import asyncio
+import binascii
+import functools
 import os
+import re
+import json
+import time
+import random
 import email
+import email.parser
 import email.policy
 from email.message import EmailMessage
-from typing import Optional
+from email.utils import parseaddr
+from typing import Any, Callable, Coroutine, Iterator, Optional
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
 import logging
 import uvicorn
+from aiolimiter import AsyncLimiter
 from fastapi import FastAPI
 from imapclient import IMAPClient
 from telegram import Bot, Update, ReactionTypeEmoji
-from telegram.constants import ChatType
-from telegram.ext import Application, ApplicationBuilder, ContextTypes, MessageHandler, filters
+from telegram.ext import Application, ApplicationBuilder, ContextTypes, ExtBot, MessageHandler, filters
 from telegram.request import HTTPXRequest
 
-from .config import load_settings
-from .storage import Storage
+from .config import load_settings, normalize_email
+from .storage import Storage, reserve_unique_path
 
 
 app = FastAPI()
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 logger = logging.getLogger(__name__)
 
+# Парсер без состояния между вызовами — создаём один раз на модуль
+_PARSER = email.parser.BytesParser(policy=email.policy.default)
+# Предельный размер блока заголовков письма, байт
+_MAX_HEADER_BYTES = 64 * 1024
+_HEADER_END_RE = re.compile(rb"\r?\n\r?\n")
+# Всё, что не входит в алфавит base64 (пробелы, переводы строк, мусор, паддинг)
+_BASE64_JUNK_RE = re.compile(r"[^A-Za-z0-9+/]+")
+# Сколько писем забирать одной командой FETCH
+_IMAP_FETCH_BATCH = 50
+# И сколько байт тел писем (по RFC822.SIZE) держать в памяти за один FETCH
+_IMAP_FETCH_MAX_BYTES = 32 * 1024 * 1024
+_IMAP_HEADER_FETCH = b"BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)]"
+# Сколько писем одновременно разбираем и пишем на диск
+_EMAIL_SAVE_CONCURRENCY = 4
+# Сервер может разорвать IDLE через 30 минут, поэтому продлеваем его раньше
+_IMAP_IDLE_RENEW = 29 * 60
+# Общий лимит исходящих сообщений и реакций бота (глобальный лимит Telegram — 30 в секунду)
+_TG_SEND_LIMITER = AsyncLimiter(28, 1)
+# Потолок паузы между переподключениями к IMAP при ошибках, секунд
+_IMAP_MAX_BACKOFF = 900
+# Файл с последним обработанным UID (в пределах UIDVALIDITY) в STORAGE_DIR
+_IMAP_STATE_FILE = ".imap_state.json"
+# Адрес из заголовка From: "Имя <addr>" или просто "addr"
+_FROM_RE = re.compile(rb"^From:\s*(?:[^<\n]*<)?([^>\s@]+@[^>\s]+)", re.IGNORECASE | re.MULTILINE)
+
 
 async def run_http_server(port: int):
-    config = uvicorn.Config(app, host="0.0.0.0", port=port, log_level="info")
+    # /health дёргается часто: без access-логов и на C-парсере httptools
+    config = uvicorn.Config(app, host="0.0.0.0", port=port, log_level="warning", access_log=False, http="httptools")
     server = uvicorn.Server(config)
     await server.serve()
 
@@ -36,123 +70,375 @@ def health():
     return {"ok": True}
 
 
-def is_email_whitelisted(sender: Optional[str], whitelist: set[str]) -> bool:
-    if not sender:
-        return False
-    return sender.lower() in whitelist
-
-
-def parse_email_message(msg_bytes: bytes) -> tuple[str, Optional[str], Optional[str], list[tuple[str, bytes]]]:
-    msg: EmailMessage = email.message_from_bytes(msg_bytes, policy=email.policy.default)  # type: ignore
+def _cap_headers(msg_bytes: bytes) -> bytes:
+    # Парсер email на патологических заголовках работает очень долго: отрезаем всё сверх лимита
+    m = _HEADER_END_RE.search(msg_bytes)
+    header_end = m.start() if m else len(msg_bytes)
+    if header_end <= _MAX_HEADER_BYTES:
+        return msg_bytes
+    cut = msg_bytes.rfind(b"\n", 0, _MAX_HEADER_BYTES) + 1
+    logger.warning("Заголовки письма длиннее %s байт (%s), лишнее отброшено", _MAX_HEADER_BYTES, header_end)
+    if m is None:
+        return msg_bytes[:cut]
+    return msg_bytes[:cut] + b"\r\n" + msg_bytes[m.end():]
+
+
+def _iter_base64_chunks(encoded: str, chunk_size: int = 76 * 1024) -> Iterator[bytes]:
+    # Закодированная строка уже в памяти; кусками (кратными 4 символам) выдаём только
+    # декодированные байты. Срез не выровнен по строкам: переводы строк и прочие символы
+    # вне алфавита base64 (включая "=") выбрасываются до выравнивания — иначе один мусорный
+    # символ сдвигает квартеты и a2b_base64 падает, хотя email-пакет такое письмо декодирует.
+    # Паддинг восстанавливаем сами в хвосте
+    tail = ""
+    for start in range(0, len(encoded), chunk_size):
+        piece = tail + _BASE64_JUNK_RE.sub("", encoded[start:start + chunk_size])
+        cut = len(piece) - len(piece) % 4
+        tail = piece[cut:]
+        if cut:
+            yield binascii.a2b_base64(piece[:cut])
+    if tail:
+        # Обрезанный хвост: как и email-пакет, лишний символ отбрасываем, паддинг дописываем
+        if len(tail) % 4 == 1:
+            tail = tail[:-1]
+        if tail:
+            yield binascii.a2b_base64(tail + "=" * (-len(tail) % 4))
+
+
+def _attachment_chunks(part: EmailMessage) -> Callable[[], Iterator[bytes]]:
+    if part.get("Content-Transfer-Encoding", "").strip().lower() == "base64":
+        encoded = part.get_payload(decode=False)
+        return lambda: _iter_base64_chunks(encoded)
+    return lambda: iter((part.get_payload(decode=True) or b"",))
+
+
+def _iter_attachment_parts(msg: EmailMessage) -> Iterator[EmailMessage]:
+    for part in msg.iter_attachments():
+        if part.get_content_maintype() == "multipart":
+            # Вложенные multipart
+            yield from _iter_attachment_parts(part)
+        elif part.get_content_type() == "message/rfc822":
+            # Письмо, пересланное вложением: сохраняем файлы из него, а не пустую обёртку
+            inner = part.get_payload(0)
+            if inner.is_multipart():
+                yield from _iter_attachment_parts(inner)
+        elif part.is_attachment() or part.get_filename():
+            # Именованные inline-части (картинки в теле письма) сохраняем как вложения;
+            # безымянные inline-части (куски текста между вложениями) файлами не считаем
+            yield part
+
+
+def parse_email_message(msg_bytes: bytes) -> tuple[str, Optional[str], Optional[str], Optional[str], list[tuple[str, Callable[[], Iterator[bytes]]]]]:
+    msg: EmailMessage = _PARSER.parsebytes(_cap_headers(msg_bytes))  # type: ignore
     sender = msg.get("From")
     subject = msg.get("Subject")
     text_body: Optional[str] = None
     html_body: Optional[str] = None
-    attachments: list[tuple[str, bytes]] = []
-
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_disposition = part.get_content_disposition()
-            content_type = part.get_content_type()
-            if content_disposition == "attachment":
-                filename = part.get_filename() or "attachment"
-                payload = part.get_payload(decode=True) or b""
-                attachments.append((filename, payload))
-            elif content_type == "text/plain" and text_body is None:
-                payload = part.get_payload(decode=True) or b""
-                text_body = payload.decode(part.get_content_charset() or "utf-8", errors="replace")
-            elif content_type == "text/html" and html_body is None:
-                payload = part.get_payload(decode=True) or b""
-                html_body = payload.decode(part.get_content_charset() or "utf-8", errors="replace")
-    else:
-        content_type = msg.get_content_type()
-        payload = msg.get_payload(decode=True) or b""
-        if content_type == "text/plain":
-            text_body = payload.decode(msg.get_content_charset() or "utf-8", errors="replace")
-        elif content_type == "text/html":
-            html_body = payload.decode(msg.get_content_charset() or "utf-8", errors="replace")
+    # Вложения декодируются лениво — при записи на диск
+    attachments: list[tuple[str, Callable[[], Iterator[bytes]]]] = []
+
+    # get_body сам выбирает основную часть (plain предпочтительнее html), не обходя всё дерево
+    body_part = msg.get_body(preferencelist=("plain", "html"))
+    if body_part is not None:
+        payload = body_part.get_payload(decode=True) or b""
+        body = payload.decode(body_part.get_content_charset() or "utf-8", errors="replace")
+        if body_part.get_content_subtype() == "plain":
+            text_body = body
+        else:
+            html_body = body
+    for part in _iter_attachment_parts(msg):
+        filename = part.get_filename() or "attachment"
+        attachments.append((filename, _attachment_chunks(part)))
+
+    # HTML отдаём отдельно: Storage сам переведёт его в Markdown
+    return sender or "", subject, text_body, html_body, attachments
+
+
+def _parse_email_headers(header_bytes: bytes) -> tuple[str, Optional[str]]:
+    # policy.default разбирает заголовки лениво: трогаем только Subject,
+    # а адрес отправителя достаём регуляркой, минуя медленный парсер адресов
+    msg: EmailMessage = _PARSER.parsebytes(_cap_headers(header_bytes), headersonly=True)  # type: ignore
+    subject = msg.get("Subject")
+    m = _FROM_RE.search(header_bytes)
+    if m:
+        return m.group(1).decode("ascii", "ignore"), subject
+    # Нестандартная запись From — разбираем полноценно
+    sender = str(msg.get("From") or "")
+    return parseaddr(sender)[1] or sender, subject
+
+
+def _fetched_header(data: dict) -> bytes:
+    # Сервер может вернуть ключ в своей записи (регистр/кавычки полей), ищем по префиксу
+    for key, value in data.items():
+        if isinstance(key, bytes) and key.upper().startswith(b"BODY[HEADER"):
+            return value or b""
+    return b""
+
+
+def _iter_fetch_batches(uids: list[int], sizes: dict[int, int]) -> Iterator[list[int]]:
+    # Режем по числу писем и суммарному размеру; крупное письмо идёт отдельной пачкой
+    batch: list[int] = []
+    batch_bytes = 0
+    for uid in uids:
+        size = sizes.get(uid, 0)
+        if batch and (len(batch) >= _IMAP_FETCH_BATCH or batch_bytes + size > _IMAP_FETCH_MAX_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(uid)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+# Последняя отформатированная минута для уведомлений: [номер минуты эпохи, "ЧЧ:ММ"]
+_LAST_MIN: list = [-1, ""]
+
+
+def _hhmm_now(tz: ZoneInfo) -> str:
+    # Время для уведомлений меняется раз в минуту — форматируем его один раз на минуту
+    minute = int(time.time()) // 60
+    if minute != _LAST_MIN[0]:
+        _LAST_MIN[:] = [minute, datetime.now(tz).strftime("%H:%M")]
+    return _LAST_MIN[1]
+
+
+def _load_imap_state(storage_dir: str) -> dict:
+    path = os.path.join(storage_dir, _IMAP_STATE_FILE)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        return {"uidvalidity": int(state["uidvalidity"]), "last_uid": int(state["last_uid"])}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning("Не удалось прочитать состояние IMAP %s: %s", path, e)
+        return {}
 
-    return sender or "", subject, text_body or html_body or "", attachments
 
+def _save_imap_state(storage_dir: str, state: dict) -> None:
+    path = os.path.join(storage_dir, _IMAP_STATE_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
-async def imap_worker(settings, storage: Storage):
-    if not settings.imap_host or not settings.imap_user or not settings.imap_password:
+
+async def _send_notification(bot: Bot, chat_id: int, text: str, error_message: str) -> None:
+    try:
+        async with _TG_SEND_LIMITER:
+            await bot.send_message(chat_id=chat_id, text=text)
+    except Exception as e:
+        logger.warning("%s: %s", error_message, e)
+
+
+async def _imap_process_unseen(client: IMAPClient, settings, save_email: Callable[..., str], bot: Optional[Bot], tz: ZoneInfo, state: dict) -> None:
+    last_uid = state["last_uid"]
+    if last_uid:
+        # "N:*" всегда включает последнее письмо ящика, даже если его UID < N — отфильтруем
+        found = await asyncio.to_thread(client.search, ["UID", f"{last_uid + 1}:*", "UNSEEN"])
+        messages = [uid for uid in found if uid > last_uid]
+    else:
+        messages = await asyncio.to_thread(client.search, ["UNSEEN"])  # простая стратегия: только новые
+    if not messages:
         return
-    bot: Optional[Bot] = None
-    if settings.telegram_bot_token and settings.telegram_notify_chat_id:
+    # Уведомления копим и отправляем параллельно в конце, не задерживая FETCH
+    pending_notifications: list[Coroutine[Any, Any, None]] = []
+    try:
+        # Сначала только заголовки: белый список проверяем, не скачивая тело и вложения
+        headers = await asyncio.to_thread(client.fetch, messages, [_IMAP_HEADER_FETCH, b"RFC822.SIZE"])
+        accepted: dict[int, str] = {}
+        sizes: dict[int, int] = {}
+        seen_uids: list[int] = []
+        for uid, data in headers.items():
+            sender_email, subject = _parse_email_headers(_fetched_header(data))
+            time_str = _hhmm_now(tz)
+            logger.info("Получено письмо UID=%s от %s с темой '%s'", uid, sender_email, subject)
+            if settings.is_email_whitelisted(normalize_email(sender_email)):
+                logger.info("Письмо %s от %s прошло проверку белого списка", uid, sender_email)
+                accepted[uid] = sender_email
+                sizes[uid] = data.get(b"RFC822.SIZE") or 0
+                continue
+            logger.info("Письмо от %s в %s не прошло проверку белого списка", sender_email, time_str)
+            # Тело не скачиваем (PEEK), поэтому отмечаем прочитанным явно, чтобы не уведомлять повторно
+            seen_uids.append(uid)
+            if bot and settings.telegram_notify_chat_id:
+                pending_notifications.append(_send_notification(
+                    bot,
+                    settings.telegram_notify_chat_id,
+                    f"Сообщение от {sender_email} в {time_str} проигнорировано",
+                    f"Не удалось отправить уведомление о не-белом письме в Telegram о письме {uid} от {sender_email}",
+                ))
+
+        storage_sem = asyncio.Semaphore(_EMAIL_SAVE_CONCURRENCY)
+
+        async def _handle_uid(uid: int, data: dict) -> None:
+            sender_email = accepted[uid]
+            time_str = _hhmm_now(tz)
+            try:
+                msg_bytes: bytes = data[b"BODY[]"]  # type: ignore
+                # Разбор MIME и запись на диск — блокирующая работа, уводим её из event loop;
+                # семафор ограничивает число одновременно пишущих на диск потоков
+                async with storage_sem:
+                    _, subject, text_body, html_body, attachments = await asyncio.to_thread(parse_email_message, msg_bytes)
+                    path = await asyncio.to_thread(
+                        save_email,
+                        sender=sender_email,
+                        subject=subject,
+                        text_body=text_body,
+                        html_body=html_body,
+                        attachments=attachments,
+                    )
+                seen_uids.append(uid)
+                logger.info("Письмо сохранено: %s", path)
+                # Уведомление в Telegram (только сообщение "принято ...")
+                if bot and settings.telegram_notify_chat_id:
+                    pending_notifications.append(_send_notification(
+                        bot,
+                        settings.telegram_notify_chat_id,
+                        f"Сообщение от {sender_email} в {time_str} записано",
+                        f"Не удалось отправить уведомление в Telegram о письме {uid} от {sender_email}",
+                    ))
+            except Exception as e:
+                logger.error("Ошибка сохранения письма %s от %s: %s", uid, sender_email, e)
+                if bot and settings.telegram_notify_chat_id:
+                    pending_notifications.append(_send_notification(
+                        bot,
+                        settings.telegram_notify_chat_id,
+                        f"Получено письмо от {sender_email} в {time_str}, ошибка сохранения (прикрепленный файл или все письмо не сохранено)",
+                        f"Не удалось отправить уведомление об ошибке в Telegram о письме {uid} от {sender_email}",
+                    ))
+
+        for chunk in _iter_fetch_batches(list(accepted), sizes):
+            # BODY.PEEK[] не ставит \Seen: флаг выставляем только после успешного сохранения
+            raw_all = await asyncio.to_thread(client.fetch, chunk, [b"BODY.PEEK[]"])
+            await asyncio.gather(*(_handle_uid(uid, data) for uid, data in raw_all.items()), return_exceptions=True)
+        # Реакция: отметить прочитанными все обработанные письма одной командой
+        if seen_uids:
+            await asyncio.to_thread(client.add_flags, seen_uids, [b"\\Seen"])
+        # Двигаем last_uid только до первого письма, которое не удалось сохранить, чтобы оно
+        # попало в следующий проход
+        failed_uids = set(accepted).difference(seen_uids)
+        new_last_uid = min(failed_uids) - 1 if failed_uids else max(messages)
+        if new_last_uid > last_uid:
+            state["last_uid"] = new_last_uid
+            await asyncio.to_thread(_save_imap_state, settings.storage_dir, state)
+    finally:
+        if pending_notifications:
+            await asyncio.gather(*pending_notifications, return_exceptions=True)
+
+
+def _imap_connect(settings) -> tuple[IMAPClient, int, bool]:
+    client = IMAPClient(settings.imap_host, port=settings.imap_port, ssl=settings.imap_ssl)
+    try:
+        client.login(settings.imap_user, settings.imap_password)
+        folder_info = client.select_folder("INBOX")
+        uidvalidity = int(folder_info.get(b"UIDVALIDITY", 0))
+        return client, uidvalidity, client.has_capability("IDLE")
+    except Exception:
+        _imap_logout(client)
+        raise
+
+
+def _imap_logout(client: IMAPClient) -> None:
+    # Как IMAPClient.__exit__: вежливый LOGOUT, а если не вышло — просто закрываем сокет
+    try:
+        client.logout()
+    except Exception:
         try:
-            bot_kwargs = {}
-            if settings.telegram_proxy_url:
-                bot_kwargs["request"] = HTTPXRequest(proxy=settings.telegram_proxy_url)
-            bot = Bot(token=settings.telegram_bot_token, **bot_kwargs)
+            client.shutdown()
         except Exception:
-            bot = None
+            pass
+
+
+def _imap_idle_wait(client: IMAPClient, timeout: float) -> list:
+    client.idle()
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            responses = client.idle_check(timeout=remaining)
+            # Остальные ответы (EXPUNGE, FETCH, keep-alive сервера) новых писем не означают
+            if any(b"EXISTS" in r or b"RECENT" in r for r in responses if isinstance(r, tuple)):
+                return responses
+    finally:
+        client.idle_done()
+
+
+async def imap_worker(settings, storage: Storage, bot: Optional[Bot]):
+    if not settings.imap_host or not settings.imap_user or not settings.imap_password:
+        return
+    tz = storage.tz
+    save_email = functools.partial(storage.save_markdown_message, source="email")
+    # Письмо, пришедшее во время прохода UNSEEN, сервер сообщает вместе с ответами на FETCH/STORE —
+    # imaplib откладывает этот EXISTS, и начатый следом IDLE его уже не увидит. Поэтому IDLE
+    # не держим дольше интервала опроса: задержка такого письма не больше, чем при опросе
+    idle_timeout = min(settings.imap_poll_interval, _IMAP_IDLE_RENEW)
+    base_backoff = max(10, settings.imap_poll_interval)
+    backoff = base_backoff
     while True:
         try:
-            ssl = settings.imap_ssl
-            with IMAPClient(settings.imap_host, port=settings.imap_port, ssl=ssl) as client:
-                client.login(settings.imap_user, settings.imap_password)
-                client.select_folder("INBOX")
-                messages = client.search(["UNSEEN"])  # простая стратегия: только новые
-                for uid in messages:
-                    raw = client.fetch([uid], ["RFC822"])  # type: ignore
-                    msg_bytes: bytes = raw[uid][b"RFC822"]  # type: ignore
-                    sender, subject, body, attachments = parse_email_message(msg_bytes)
-                    # Извлечём email-адрес из поля From
-                    sender_email = sender
-                    if "<" in sender and ">" in sender:
-                        sender_email = sender.split("<")[-1].split(">")[0].strip()
-                    time_str = datetime.now(ZoneInfo(settings.timezone)).strftime("%H:%M")
-                    logger.info(f"Получено письмо UID={uid} от {sender_email} с темой '{subject}'")
-                    if is_email_whitelisted(sender_email, settings.whitelist_emails):
-                        logger.info(f"Письмо {uid} от {sender_email} прошло проверку белого списка")
-                        try:
-                            path = storage.save_markdown_message(
-                                source="email",
-                                sender=sender_email,
-                                subject=subject,
-                                text_body=body,
-                                attachments=attachments,
-                            )
-                            # Реакция: отметить прочитанным
-                            client.add_flags([uid], [b"\\Seen"])  # type: ignore
-                            logger.info(f"Письмо сохранено: {path}")
-                            # Уведомление в Telegram (только сообщение "принято ...")
-                            if bot and settings.telegram_notify_chat_id:
-                                try:
-                                    await bot.send_message(
-                                        chat_id=settings.telegram_notify_chat_id,
-                                        text=f"Сообщение от {sender_email} в {time_str} записано"
-                                    )
-                                except Exception as e:
-                                    logger.warning(f"Не удалось отправить уведомление в Telegram о письме {uid} от {sender_email}: {e}")
-                        except Exception as e:
-                            logger.error(f"Ошибка сохранения письма {uid} от {sender_email}: {e}")
-                            if bot and settings.telegram_notify_chat_id:
-                                try:
-                                    await bot.send_message(
-                                        chat_id=settings.telegram_notify_chat_id,
-                                        text=f"Получено письмо от {sender_email} в {time_str}, ошибка сохранения (прикрепленный файл или все письмо не сохранено)"
-                                    )
-                                except Exception as e2:
-                                    logger.warning(f"Не удалось отправить уведомление об ошибке в Telegram о письме {uid} от {sender_email}: {e2}")
-                    else:
-                        logger.info(f"Письмо от {sender_email} в {time_str} не прошло проверку белого списка")
-                        if bot and settings.telegram_notify_chat_id:
-                            try:
-                                await bot.send_message(
-                                    chat_id=settings.telegram_notify_chat_id,
-                                    text=f"Сообщение от {sender_email} в {time_str} проигнорировано"
-                                )
-                            except Exception as e:
-                                logger.warning(f"Не удалось отправить уведомление о не-белом письме в Telegram о письме {uid} от {sender_email}: {e}")
-                await asyncio.sleep(settings.imap_poll_interval)
+            # IMAPClient синхронный: все сетевые вызовы выполняем в потоках, чтобы не блокировать event loop
+            client, uidvalidity, idle_supported = await asyncio.to_thread(_imap_connect, settings)
+            try:
+                state = _load_imap_state(settings.storage_dir)
+                if state.get("uidvalidity") != uidvalidity:
+                    # Ящик пересоздан или состояния ещё нет — UID прошлых сессий недействительны
+                    state = {"uidvalidity": uidvalidity, "last_uid": 0}
+                # Подключились — сбрасываем экспоненциальную паузу
+                backoff = base_backoff
+                while True:
+                    await _imap_process_unseen(client, settings, save_email, bot, tz, state)
+                    if not idle_supported:
+                        await asyncio.sleep(settings.imap_poll_interval)
+                        continue
+                    # Ждём push-уведомления о новых письмах; не реже чем раз в idle_timeout (и не реже
+                    # 29 минут, RFC 2177) IDLE перезапускается и UNSEEN перепроверяется
+                    responses = await asyncio.to_thread(_imap_idle_wait, client, idle_timeout)
+                    if responses:
+                        logger.debug("IMAP IDLE: получены уведомления %s", responses)
+            finally:
+                await asyncio.to_thread(_imap_logout, client)
         except Exception as e:
-            logger.error(f"Ошибка IMAP-цикла: {e}")
-            await asyncio.sleep(max(10, settings.imap_poll_interval))
+            logger.error("Ошибка IMAP-цикла: %s", e)
+            # Экспоненциальная пауза с джиттером, чтобы не долбить сервер во время сбоя
+            await asyncio.sleep(backoff + random.uniform(0, backoff * 0.1))
+            backoff = min(_IMAP_MAX_BACKOFF, backoff * 2)
 
 
 # ===================== Telegram =====================
+# Сколько вложений Telegram скачиваем одновременно и размер пула HTTP-соединений бота
+_TG_DOWNLOAD_CONCURRENCY = 4
+_TG_CONNECTION_POOL_SIZE = 64
+# Типы медиа Telegram: атрибут сообщения -> (имя файла, отображаемое имя).
+# Фото — отдельно: это список размеров, а не один объект
+_TG_MEDIA: tuple[tuple[str, Callable[[Any], tuple[str, Optional[str]]]], ...] = (
+    ("document", lambda d: (d.file_name or f"document_{d.file_unique_id}", d.file_name)),
+    ("audio", lambda a: (a.file_name or f"audio_{a.file_unique_id}.mp3", a.file_name)),
+    ("voice", lambda v: (f"voice_{v.file_unique_id}.ogg", None)),
+    ("video", lambda v: (v.file_name or f"video_{v.file_unique_id}.mp4", None)),
+    ("video_note", lambda v: (f"video_note_{v.file_unique_id}.mp4", None)),
+    ("animation", lambda a: (a.file_name or f"animation_{a.file_unique_id}.mp4", None)),
+    # Стикеры могут быть .webp/.tgs; Telegram отдаст реальный файл
+    ("sticker", lambda s: (f"sticker_{s.file_unique_id}{'.tgs' if s.is_animated else '.webp'}", None)),
+)
+# Сколько ждать следующих элементов альбома (media group) перед сохранением, секунд
+_MEDIA_GROUP_DELAY = 1.2
+
+
+async def _set_reaction(bot: Bot, chat_id: int, message_id: int, emoji: str) -> None:
+    async with _TG_SEND_LIMITER:
+        await bot.set_message_reaction(
+            chat_id=chat_id,
+            message_id=message_id,
+            reaction=[ReactionTypeEmoji(emoji=emoji)],
+            is_big=False,
+        )
+
+
 def _is_tg_user_whitelisted(username: Optional[str], user_id: Optional[int], settings) -> bool:
     if user_id is not None and user_id in settings.whitelist_tg_ids:
         return True
@@ -161,64 +447,79 @@ def _is_tg_user_whitelisted(username: Optional[str], user_id: Optional[int], set
     return False
 
 
+class _WhitelistedUserFilter(filters.MessageFilter):
+    # filters.User сравнивает username с учётом регистра, а whitelist хранится в нижнем
+    def __init__(self, settings):
+        super().__init__(name="whitelisted_user")
+        self._settings = settings
+
+    def filter(self, message) -> bool:
+        user = message.from_user
+        return user is not None and _is_tg_user_whitelisted(user.username, user.id, self._settings)
+
+
+def _build_message_filter(settings) -> filters.BaseFilter:
+    # Целевой чат или личка с пользователем из whitelist; остальное отсекает PTB до хендлера
+    target = filters.ChatType.PRIVATE & _WhitelistedUserFilter(settings)
+    if settings.telegram_notify_chat_id is not None:
+        target = filters.Chat(chat_id=settings.telegram_notify_chat_id) | target
+    return target & ~filters.StatusUpdate.ALL
+
+
+def _write_file(path: str, content: bytes | bytearray) -> None:
+    with open(path, "wb") as f:
+        f.write(content)
+
+
 async def _download_and_save_telegram_attachments(update: Update, context: ContextTypes.DEFAULT_TYPE, storage: Storage) -> tuple[list[str], list[tuple[str, str]]]:
     saved_names: list[str] = []
     display_and_saved: list[tuple[str, str]] = []
     message = update.effective_message
     if not message:
-        return saved_names
+        return saved_names, display_and_saved
+    # Общий на всё приложение лимит параллельных скачиваний
+    download_sem: asyncio.Semaphore = context.application.bot_data["download_semaphore"]
 
-    async def _save_file(file_id: str, suggested_name: str, display_name: Optional[str] = None) -> None:
+    async def _save_file(file_id: str, suggested_name: str, display_name: Optional[str] = None) -> Optional[tuple[str, str]]:
         try:
-            tg_file = await context.bot.get_file(file_id)
-            # Сохраняем напрямую в каталог вложений
-            target_name = suggested_name
-            # Гарантируем уникальность имени
-            base_path = os.path.join(storage.attachments_dir, target_name)
-            unique_path = base_path
-            counter = 1
-            while os.path.exists(unique_path):
-                name, ext = os.path.splitext(target_name)
-                unique_path = os.path.join(storage.attachments_dir, f"{name}_{counter}{ext}")
-                counter += 1
-            await tg_file.download_to_drive(custom_path=unique_path)
-            saved_names.append(os.path.basename(unique_path))
-            display_and_saved.append((display_name or suggested_name, os.path.basename(unique_path)))
-            logger.info(f"Сохранён файл Telegram: {unique_path}")
+            async with download_sem:
+                tg_file = await context.bot.get_file(file_id)
+                # Сохраняем напрямую в каталог вложений под гарантированно уникальным именем
+                unique_path = reserve_unique_path(storage.attachments_dir, suggested_name)
+                try:
+                    # download_to_drive пишет файл прямо в event loop — качаем в память,
+                    # а на диск пишем в отдельном потоке
+                    content = await tg_file.download_as_bytearray()
+                    await asyncio.to_thread(_write_file, unique_path, content)
+                except Exception:
+                    # Не оставляем пустой зарезервированный файл
+                    try:
+                        os.unlink(unique_path)
+                    except OSError:
+                        pass
+                    raise
+            logger.info("Сохранён файл Telegram: %s", unique_path)
+            return display_name or suggested_name, os.path.basename(unique_path)
         except Exception as e:
-            logger.warning(f"Не удалось сохранить вложение Telegram {suggested_name}: {e}")
-
-    # Документы, аудио, видео, фото, голос, стикер, гиф (animation), видеосообщение
-    if message.document:
-        file_name = message.document.file_name or f"document_{message.document.file_unique_id}"
-        await _save_file(message.document.file_id, file_name, display_name=message.document.file_name)
-    if message.audio:
-        file_name = message.audio.file_name or f"audio_{message.audio.file_unique_id}.mp3"
-        await _save_file(message.audio.file_id, file_name, display_name=message.audio.file_name)
-    if message.voice:
-        file_name = f"voice_{message.voice.file_unique_id}.ogg"
-        await _save_file(message.voice.file_id, file_name)
-    if message.video:
-        file_name = message.video.file_name or f"video_{message.video.file_unique_id}.mp4"
-        await _save_file(message.video.file_id, file_name)
-    if message.video_note:
-        file_name = f"video_note_{message.video_note.file_unique_id}.mp4"
-        await _save_file(message.video_note.file_id, file_name)
-    if message.animation:
-        file_name = message.animation.file_name or f"animation_{message.animation.file_unique_id}.mp4"
-        await _save_file(message.animation.file_id, file_name)
-    if message.sticker:
-        # Стикеры могут быть .webp/.tgs; Telegram отдаст реальный файл
-        ext = ".webp"
-        if message.sticker.is_animated:
-            ext = ".tgs"
-        file_name = f"sticker_{message.sticker.file_unique_id}{ext}"
-        await _save_file(message.sticker.file_id, file_name)
+            logger.warning("Не удалось сохранить вложение Telegram %s: %s", suggested_name, e)
+            return None
+
+    # Скачиваем параллельно; порядок результатов сохраняется
+    downloads: list[Coroutine[Any, Any, Optional[tuple[str, str]]]] = []
+    for attr, namer in _TG_MEDIA:
+        media = getattr(message, attr)
+        if media:
+            file_name, display_name = namer(media)
+            downloads.append(_save_file(media.file_id, file_name, display_name=display_name))
     if message.photo:
         # Берём самое большое фото
         photo = message.photo[-1]
-        file_name = f"photo_{photo.file_unique_id}.jpg"
-        await _save_file(photo.file_id, file_name)
+        downloads.append(_save_file(photo.file_id, f"photo_{photo.file_unique_id}.jpg"))
+
+    for result in await asyncio.gather(*downloads):
+        if result:
+            saved_names.append(result[1])
+            display_and_saved.append(result)
 
     return saved_names, display_and_saved
 
@@ -234,17 +535,12 @@ async def telegram_message_handler(update: Update, context: ContextTypes.DEFAULT
     if message.from_user and message.from_user.is_bot:
         return
 
+    # Чат и whitelist уже проверены фильтром хендлера
     chat = message.chat
     user = message.from_user
     username = user.username if user else None
     user_id = user.id if user else None
 
-    in_target_group = settings.telegram_notify_chat_id is not None and chat.id == settings.telegram_notify_chat_id
-    is_private_and_whitelisted = (chat.type == ChatType.PRIVATE) and _is_tg_user_whitelisted(username, user_id, settings)
-
-    if not (in_target_group or is_private_and_whitelisted):
-        return
-
     # Текст сообщения или подпись к медиа
     text_body = message.text or message.caption or ""
 
@@ -284,6 +580,7 @@ async def telegram_message_handler(update: Update, context: ContextTypes.DEFAULT
                 "has_animation": False,
                 "has_voice": False,
                 "has_sticker": False,
+                "deadline": 0.0,
                 "task": None,
             }
             media_groups[group_key] = state
@@ -301,17 +598,15 @@ async def telegram_message_handler(update: Update, context: ContextTypes.DEFAULT
         if message.sticker:
             state["has_sticker"] = True
 
-        # Перепланируем финализацию группы: 1.2 секунды после последнего элемента (через asyncio)
-        try:
-            if state.get("task"):
-                try:
-                    state["task"].cancel()
-                except Exception:
-                    pass
-            state["task"] = asyncio.create_task(_finalize_media_group_after_delay(context.application, group_key, 1.2))
-            logger.info(f"Запланирована финализация media_group {group_key} через 1.2с, элементов уже: {len(state['saved_names'])}")
-        except Exception as e:
-            logger.error(f"Не удалось запланировать финализацию media_group {group_key}: {e}")
+        # Финализация группы — через 1.2 секунды после последнего элемента. Каждый элемент
+        # только сдвигает дедлайн, а ждёт его одна задача на весь альбом
+        state["deadline"] = asyncio.get_running_loop().time() + _MEDIA_GROUP_DELAY
+        if state.get("task") is None:
+            try:
+                state["task"] = asyncio.create_task(_finalize_media_group_after_delay(context.application, group_key))
+            except Exception as e:
+                logger.error("Не удалось запланировать финализацию media_group %s: %s", group_key, e)
+        logger.info("Финализация media_group %s через %sс, элементов уже: %s", group_key, _MEDIA_GROUP_DELAY, len(state['saved_names']))
 
         # Поки что ничего не сохраняем (ждём финализации группы)
         return
@@ -321,56 +616,53 @@ async def telegram_message_handler(update: Update, context: ContextTypes.DEFAULT
     sender = username or str(user_id or "unknown")
 
     try:
-        path = storage.save_markdown_message(
-            source="telegram",
+        path = context.application.bot_data["save_telegram"](
             sender=sender,
             subject=subject,
             text_body=text_body,
-            attachments=None,
             pre_saved_attachment_names=saved_attachment_names,
             pre_saved_attachments=display_and_saved,
             extra_meta={"tg_title_label": fallback_label} if fallback_label else None,
         )
         # Реакция на сообщение вместо ответа
         try:
-            await context.bot.set_message_reaction(
-                chat_id=message.chat_id,
-                message_id=message.message_id,
-                reaction=[ReactionTypeEmoji(emoji="👍")],
-                is_big=False,
-            )
+            await _set_reaction(context.bot, message.chat_id, message.message_id, "👍")
         except Exception:
             pass
-        logger.info(f"Сообщение Telegram сохранено: {path}")
+        logger.info("Сообщение Telegram сохранено: %s", path)
     except Exception as e:
-        logger.error(f"Ошибка сохранения сообщения из Telegram: {e}")
+        logger.error("Ошибка сохранения сообщения из Telegram: %s", e)
         try:
-            await context.bot.set_message_reaction(
-                chat_id=message.chat_id,
-                message_id=message.message_id,
-                reaction=[ReactionTypeEmoji(emoji="⚠️")],
-                is_big=False,
-            )
+            await _set_reaction(context.bot, message.chat_id, message.message_id, "⚠️")
         except Exception:
             pass
 
 
-async def telegram_worker(settings, storage: Storage):
-    if not settings.telegram_bot_token:
+def build_telegram_bot(settings) -> ExtBot:
+    proxy_kwargs = {"proxy": settings.telegram_proxy_url} if settings.telegram_proxy_url else {}
+    # Один бот и один пул соединений на уведомления IMAP, реакции и скачивание вложений
+    request = HTTPXRequest(
+        connection_pool_size=_TG_CONNECTION_POOL_SIZE,
+        connect_timeout=5,
+        read_timeout=20,
+        pool_timeout=10,
+        **proxy_kwargs,
+    )
+    # Long polling держит соединение подолгу — у getUpdates свой запрос вне общего пула
+    get_updates_request = HTTPXRequest(**proxy_kwargs)
+    return ExtBot(token=settings.telegram_bot_token, request=request, get_updates_request=get_updates_request)
+
+
+async def telegram_worker(settings, storage: Storage, bot: Optional[ExtBot]):
+    if not bot:
         return
-    builder = ApplicationBuilder().token(settings.telegram_bot_token)
-    if settings.telegram_proxy_url:
-        builder = builder.request(
-            HTTPXRequest(proxy=settings.telegram_proxy_url)
-        ).get_updates_request(
-            HTTPXRequest(proxy=settings.telegram_proxy_url)
-        )
-    application: Application = builder.build()
+    application: Application = ApplicationBuilder().bot(bot).build()
     application.bot_data["settings"] = settings
     application.bot_data["storage"] = storage
+    application.bot_data["save_telegram"] = functools.partial(storage.save_markdown_message, source="telegram", attachments=None)
+    application.bot_data["download_semaphore"] = asyncio.Semaphore(_TG_DOWNLOAD_CONCURRENCY)
 
-    # Обрабатываем все сообщения (текст/медиа), а в хендлере фильтруем сами
-    application.add_handler(MessageHandler(filters.ALL & ~filters.StatusUpdate.ALL, telegram_message_handler))
+    application.add_handler(MessageHandler(_build_message_filter(settings), telegram_message_handler))
 
     await application.initialize()
     await application.start()
@@ -385,84 +677,11 @@ async def telegram_worker(settings, storage: Storage):
         await application.shutdown()
 
 
-async def _finalize_media_group_after_delay(application: Application, key: str, delay: float) -> None:
-    try:
-        await asyncio.sleep(delay)
-        app_data = application.bot_data
-        media_groups = app_data.get("media_groups", {})
-        state = media_groups.pop(key, None)
-        if not state:
-            return
-        settings = app_data.get("settings")
-        storage: Storage = app_data.get("storage")
-        if not settings or not storage:
-            return
-
-        chat_id = state["chat_id"]
-        message_ids = state["message_ids"]
-        saved_names = state["saved_names"]
-        display_and_saved = state["display_and_saved"]
-        text_body = state["text_body"]
-        username = state["username"]
-        user_id = state["user_id"]
-        subject = state["subject"]
-
-        # Лейбл только для особых типов, иначе используем имя первого файла
-        fallback_label = None
-        if state.get("has_animation"):
-            fallback_label = "Gif"
-        elif state.get("has_voice"):
-            fallback_label = "Голосовое сообщение"
-        elif state.get("has_sticker"):
-            fallback_label = "Стикер"
-        elif not saved_names and not (text_body and text_body.strip()):
-            fallback_label = "Сообщение"
-
-        sender = username or str(user_id or "unknown")
-        path = storage.save_markdown_message(
-            source="telegram",
-            sender=sender,
-            subject=subject,
-            text_body=text_body,
-            attachments=None,
-            pre_saved_attachment_names=saved_names,
-            pre_saved_attachments=display_and_saved,
-            extra_meta={"tg_title_label": fallback_label} if fallback_label else None,
-        )
-        logger.info(f"Media group сохранён: {path}")
-        # Реакции на все сообщения альбома
-        try:
-            for mid in message_ids:
-                await application.bot.set_message_reaction(
-                    chat_id=chat_id,
-                    message_id=mid,
-                    reaction=[ReactionTypeEmoji(emoji="👍")],
-                    is_big=False,
-                )
-        except Exception:
-            pass
-    except asyncio.CancelledError:
-        return
-    except Exception as e:
-        logger.error(f"Ошибка финализации media_group {key}: {e}")
-
-
-async def finalize_media_group(context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = context.job.data or {}
-    key = data.get("key")
-    if not key:
-        return
-    app_data = context.application.bot_data
-    media_groups = app_data.get("media_groups", {})
-    state = media_groups.pop(key, None)
-    if not state:
-        return
-    settings = app_data.get("settings")
-    storage: Storage = app_data.get("storage")
-    if not settings or not storage:
+async def _finalize_media_group_state(application: Application, state: dict) -> None:
+    save_telegram = application.bot_data.get("save_telegram")
+    if not save_telegram:
         return
 
-
     chat_id = state["chat_id"]
     message_ids = state["message_ids"]
     saved_names = state["saved_names"]
@@ -484,42 +703,82 @@ async def finalize_media_group(context: ContextTypes.DEFAULT_TYPE) -> None:
         fallback_label = "Сообщение"
 
     sender = username or str(user_id or "unknown")
-    path = storage.save_markdown_message(
-        source="telegram",
+    path = save_telegram(
         sender=sender,
         subject=subject,
         text_body=text_body,
-        attachments=None,
         pre_saved_attachment_names=saved_names,
         pre_saved_attachments=display_and_saved,
         extra_meta={"tg_title_label": fallback_label} if fallback_label else None,
     )
-    logger.info(f"Media group сохранён: {path}")
-    # Ставим реакции на все сообщения этой группы
+    logger.info("Media group сохранён: %s", path)
+    # Реакции на все сообщения альбома — параллельно; сбой одной не отменяет остальные
+    results = await asyncio.gather(
+        *(_set_reaction(application.bot, chat_id, mid, "👍") for mid in message_ids),
+        return_exceptions=True,
+    )
+    for mid, result in zip(message_ids, results):
+        if isinstance(result, Exception):
+            logger.warning("Не удалось поставить реакцию на сообщение %s альбома: %s", mid, result)
+
+
+async def _finalize_media_group_after_delay(application: Application, key: str) -> None:
     try:
-        for mid in message_ids:
-            await context.bot.set_message_reaction(
-                chat_id=chat_id,
-                message_id=mid,
-                reaction=[ReactionTypeEmoji(emoji="👍")],
-                is_big=False,
-            )
-    except Exception:
-        pass
+        media_groups = application.bot_data.get("media_groups", {})
+        state = media_groups.get(key)
+        if not state:
+            return
+        # Досыпаем, пока новые элементы альбома сдвигают дедлайн
+        loop = asyncio.get_running_loop()
+        while (remaining := state["deadline"] - loop.time()) > 0:
+            await asyncio.sleep(remaining)
+        media_groups.pop(key, None)
+        await _finalize_media_group_state(application, state)
+    except asyncio.CancelledError:
+        return
+    except Exception as e:
+        logger.error("Ошибка финализации media_group %s: %s", key, e)
+
+
+async def finalize_media_group(context: ContextTypes.DEFAULT_TYPE) -> None:
+    data = context.job.data or {}
+    key = data.get("key")
+    if not key:
+        return
+    state = context.application.bot_data.get("media_groups", {}).pop(key, None)
+    if state:
+        await _finalize_media_group_state(context.application, state)
 
 async def main_async():
     settings = load_settings()
     storage = Storage(settings.storage_dir, settings.attachments_subdir, settings.timezone)
 
-    imap_task = asyncio.create_task(imap_worker(settings, storage))
+    bot: Optional[ExtBot] = None
+    if settings.telegram_bot_token:
+        try:
+            bot = build_telegram_bot(settings)
+        except Exception as e:
+            logger.error("Не удалось создать Telegram-бота: %s", e)
+
+    imap_task = asyncio.create_task(imap_worker(settings, storage, bot))
     http_task = asyncio.create_task(run_http_server(settings.http_port))
-    tg_task = asyncio.create_task(telegram_worker(settings, storage))
+    tg_task = asyncio.create_task(telegram_worker(settings, storage, bot))
 
-    await asyncio.gather(imap_task, http_task, tg_task)
+    try:
+        await asyncio.gather(imap_task, http_task, tg_task)
+    finally:
+        storage.close()
 
 
 def main():
-    asyncio.run(main_async())
+    # uvloop ставится вместе с uvicorn[standard]; без него работаем на стандартном цикле
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main_async())
+        return
+    with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+        runner.run(main_async())
 
 
 if __name__ == "__main__":
@@ -1,69 +1,152 @@
 import os
+import itertools
 import re
-import uuid
+import string
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from typing import Optional, Tuple
+from typing import Callable, Iterable, Iterator, Optional, Tuple, Union
 
 from html2text import html2text
 
 logger = logging.getLogger(__name__)
 
+# Содержимое вложения: готовые байты или функция, отдающая их кусками
+AttachmentData = Union[bytes, Callable[[], Iterable[bytes]]]
+
+# Неизменные части заметки, заранее в UTF-8; подставляются тег источника и дата
+_MD_HEADER = '---\ntags:\n  - "#input/%s"\nЗачем_изучать?:\ndate: "[[%s]]"\n---\n## Сообщение\n'.encode("utf-8")
+_MD_FOOTER = "---\n## Инпуты\n- [ ] Просмотреть 🔽 ⏳ %s".encode("utf-8")
+_MD_TAGS = {"telegram": b"telegram"}
+
+# Сколько символов начала текста достаточно для превью в имени файла
+_PREVIEW_SOURCE_CHARS = 500
+
+# Сколько вложений одного письма записываем одновременно
+_ATTACHMENT_WRITE_WORKERS = 4
+
+# Посимвольные замены делаем через str.translate, а не regex
+# Недопустимые в именах файлов символы для Windows/Linux — удаляются
+_FORBIDDEN = dict.fromkeys(map(ord, '\\/:*?"<>|'))
+
+
+class _SlugTable(dict):
+    # Символ вне таблицы удаляется: translate трактует None как удаление
+    def __missing__(self, key: int) -> None:
+        return None
+
+
+# В slug остаются только ASCII-буквы, цифры и -_.
+_SLUG_TABLE = _SlugTable((ord(c), ord(c)) for c in string.ascii_letters + string.digits + "-_.")
+
+# Регулярные выражения компилируем один раз на модуль
+_RE_WS = re.compile(r"\s+")
+_FWD_MARKER_HINTS = ("ересылаем", "ЕРЕСЫЛАЕМ", "orwarded", "ORWARDED")
+# Строка-маркер пересылки целиком; [^\S\n] — пробельные символы, кроме перевода строки
+_RE_FWD_MARKER = re.compile(
+    r"^[^\S\n]*-(?:-|[^\S\n]){5,}(?:Пересылаемое сообщение|Forwarded message)(?:-|[^\S\n])+-[^\S\n]*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+_RE_BLANK_LINES = re.compile(r"(?:\n[^\S\n]*)+(?:\n|\Z)")
+
 
 def _ensure_dir(path: str) -> None:
     os.makedirs(path, exist_ok=True)
 
 
+def _write_chunks(path: str, chunks: Iterable[bytes]) -> None:
+    # Пишем напрямую в дескриптор, без BufferedWriter; os.write может записать не всё
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for chunk in chunks:
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def reserve_unique_path(directory: str, file_name: str) -> str:
+    # O_EXCL атомарно создаёт файл, только если его ещё нет: одна операция на попытку
+    # и никаких гонок между параллельно сохраняемыми файлами
+    # Каталог с разделителем собираем один раз, кандидаты — простой конкатенацией
+    prefix = os.path.join(directory, "")
+    name, ext = os.path.splitext(file_name)
+    candidate = prefix + file_name
+    for counter in itertools.count(1):
+        try:
+            os.close(os.open(candidate, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            return candidate
+        except FileExistsError:
+            candidate = f"{prefix}{name}_{counter}{ext}"
+
+
+def _write_attachment(path: str, blob: AttachmentData) -> None:
+    chunks = (blob,) if isinstance(blob, bytes) else blob()
+    _write_chunks(path, chunks)
+    logger.info("Сохранено вложение: %s", path)
+
+
 def _slugify(value: str) -> str:
-    value = re.sub(r"[\n\r\t]+", " ", value).strip()
-    value = re.sub(r"\s+", "-", value)
-    value = re.sub(r"[^a-zA-Z0-9\-_.]", "", value)
-    return value[:80] or str(uuid.uuid4())
+    # split() без аргументов режет по тем же пробельным символам, что и \s+, и отбрасывает края
+    value = "-".join(value.split()).translate(_SLUG_TABLE)
+    return value[:80]
 
 
 def _sanitize_component(value: str, max_len: int = 80) -> str:
     # Сохраняем Unicode (в т.ч. кириллицу), удаляем только запрещённые для файлов символы
-    value = value.replace("\n", " ").replace("\r", " ").replace("\t", " ")
-    value = re.sub(r"\s+", " ", value).strip()
-    # Удаляем недопустимые в именах файлов символы для Windows/Linux
-    value = re.sub(r"[\\/:*?\"<>|]", "", value)
+    # Сначала удаляем недопустимые в именах файлов символы для Windows/Linux, затем одним
+    # проходом сжимаем пробелы (\n, \r, \t тоже попадают под \s) — без двойных пробелов на месте удалённых
+    value = _RE_WS.sub(" ", value.translate(_FORBIDDEN)).strip()
     # Ограничим длину компонента
     if len(value) > max_len:
         value = value[:max_len].rstrip()
     return value or "untitled"
 
 
-def _clean_preview(text: str) -> str:
-    # Удаляем HTML-теги
-    text = re.sub(r"(?is)<[^>]+>", " ", text)
-    # Удаляем системные HTML-слова, встречающиеся как отдельные токены
-    html_tokens = r"div|span|p|br|hr|script|style|table|tr|td|thead|tbody|tfoot|ul|ol|li|html|body|head|meta|link|img|a|strong|em|b|i|u|h[1-6]"
-    text = re.sub(rf"(?i)(?<![A-Za-z])(?:{html_tokens})(?![A-Za-z])", " ", text)
-    # Сжимаем пробелы
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
-
-
 def _strip_forward_headers(text: str) -> str:
     """Удаляет шапку пересылаемого письма (Yandex/Gmail) без извлечения дополнительных полей."""
-    lines = text.splitlines()
-    n = len(lines)
-    import re as _re
-    marker_re = _re.compile(r"^[-\s]{6,}(?:Пересылаемое сообщение|Forwarded message)[-\s]{2,}$", _re.IGNORECASE)
-    start_idx = None
-    for idx, line in enumerate(lines):
-        if marker_re.match(line.strip()):
-            start_idx = idx
-            break
-    if start_idx is None:
+    # Большинство писем не пересланы — дешёвая проверка подстрок до поиска маркера.
+    # Маркер ищется без учёта регистра (Thunderbird пишет "Forwarded Message"), поэтому
+    # проверяем только устойчивую часть слова и её написание капсом, остальное решает regex
+    if not any(marker in text for marker in _FWD_MARKER_HINTS):
         return text
-    i = start_idx + 1
-    while i < n and lines[i].strip() != "":
-        i += 1
-    while i < n and lines[i].strip() == "":
-        i += 1
-    return "\n".join(lines[i:]).lstrip("\n")
+    m = _RE_FWD_MARKER.search(text)
+    if m is None:
+        return text
+    # Пропускаем блок полей (От/Дата/Тема) до первой пустой строки и все пустые строки за ним
+    blank = _RE_BLANK_LINES.search(text, m.end())
+    if blank is None:
+        return ""
+    return text[blank.end():]
+
+
+def _iter_telegram_title_candidates(
+    has_text: bool,
+    text_preview: str,
+    extra_meta: Optional[dict],
+    pre_saved_attachments: Optional[list[Tuple[str, str]]],
+    pre_saved_attachment_names: Optional[list[str]],
+    attachments: Optional[list[Tuple[str, AttachmentData]]],
+) -> Iterator[Optional[str]]:
+    """Кандидаты на имя заметки Telegram в порядке приоритета; берётся первый непустой."""
+    meta = extra_meta if isinstance(extra_meta, dict) else {}
+    # Явно заданный заголовок (из хендлера Telegram) имеет высший приоритет
+    yield meta.get("tg_explicit_title")
+    # Если явного названия нет — пробуем текст (но игнорируем псевдо-"untitled")
+    if has_text and text_preview.lower() != "untitled":
+        yield text_preview
+    # Явный лейбл типа сообщения (например, "Gif", "Стикер")
+    yield meta.get("tg_title_label")
+    # Имя первого вложения. Для Telegram предпочитаем оригинальное имя, если передано вместе с сохранённым
+    if pre_saved_attachments:
+        display_name, saved_name = pre_saved_attachments[0]
+        yield display_name or saved_name
+    elif pre_saved_attachment_names:
+        yield pre_saved_attachment_names[0]
+    elif attachments:
+        yield attachments[0][0]
 
 
 class Storage:
@@ -71,13 +154,26 @@ class Storage:
         self.base_dir = base_dir
         self.attachments_dir = os.path.join(base_dir, attachments_subdir)
         self.timezone = timezone
+        self.tz = ZoneInfo(timezone)
+        # Уникальные имена: случайный префикс экземпляра + счётчик, без uuid4 на каждый файл
+        self._unique_prefix = os.urandom(4).hex()
+        self._unique_counter = itertools.count()
+        # Потоки пула создаются по мере надобности
+        self._io_pool = ThreadPoolExecutor(max_workers=_ATTACHMENT_WRITE_WORKERS, thread_name_prefix="storage-io")
         _ensure_dir(self.base_dir)
         _ensure_dir(self.attachments_dir)
 
+    def close(self) -> None:
+        # Дожидаемся начатых записей вложений и останавливаем потоки пула
+        self._io_pool.shutdown()
+
+    def _unique_name(self) -> str:
+        return f"{self._unique_prefix}{next(self._unique_counter):06x}"
+
     def _unique_filename(self, prefix: str, suffix: str = ".md") -> str:
         timestamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
-        unique = uuid.uuid4().hex[:6]
-        base = f"{timestamp}-{_slugify(prefix)}-{unique}{suffix}"
+        unique = self._unique_name()
+        base = f"{timestamp}-{_slugify(prefix) or unique}-{unique}{suffix}"
         return os.path.join(self.base_dir, base)
 
     def save_markdown_message(
@@ -87,14 +183,12 @@ class Storage:
         subject: Optional[str],
         text_body: Optional[str] = None,
         html_body: Optional[str] = None,
-        attachments: Optional[list[Tuple[str, bytes]]] = None,
+        attachments: Optional[list[Tuple[str, AttachmentData]]] = None,
         extra_meta: Optional[dict] = None,
         pre_saved_attachment_names: Optional[list[str]] = None,
         pre_saved_attachments: Optional[list[Tuple[str, str]]] = None,
     ) -> str:
-        _ensure_dir(self.base_dir)
-        _ensure_dir(self.attachments_dir)
-
+        # Каталоги создаются в __init__
         if not text_body and html_body:
             try:
                 text_body = html2text(html_body)
@@ -106,70 +200,36 @@ class Storage:
         text_body = _strip_forward_headers(text_body)
         # Определяем safe_subject и превью текста
         safe_subject = _sanitize_component(subject or "Письмо", max_len=100)
-        text_preview_src = text_body or html_body or ""
-        text_preview_clean = _clean_preview(text_preview_src)
+        # HTML к этому моменту уже переведён html2text, поэтому достаточно сжать пробелы
+        # Для имени нужно ~30 символов — не гоняем regex по всему телу письма
+        tb_stripped = text_body.strip()
+        text_preview_clean = _RE_WS.sub(" ", tb_stripped[:_PREVIEW_SOURCE_CHARS]).rstrip()
         text_preview = _sanitize_component(text_preview_clean[:30], max_len=40)
-        dt = datetime.now(ZoneInfo(self.timezone))
-        timestamp = dt.strftime("%Y-%m-%d %H-%M-%S") + f".{dt.microsecond // 1000:03d}"
+        dt = datetime.now(self.tz)
+        # Форматируем поля напрямую, без strftime
+        date_str = f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}"
+        timestamp = f"{date_str} {dt.hour:02d}-{dt.minute:02d}-{dt.second:02d}.{dt.microsecond // 1000:03d}"
         # Для Telegram формируем имя файла только на основе текста/вложений, без subject
         if source == "telegram":
-            # Явно заданный заголовок (из хендлера Telegram) имеет высший приоритет
-            preview_for_name = None
-            if extra_meta and isinstance(extra_meta, dict):
-                explicit = extra_meta.get("tg_explicit_title")  # type: ignore
-                if explicit:
-                    preview_for_name = _sanitize_component(str(explicit)[:30], max_len=40)
-            # Если явного названия нет — пробуем текст (но игнорируем псевдо-"untitled")
-            if not preview_for_name:
-                if text_body and text_body.strip() and text_preview and text_preview.lower() != "untitled":
-                    preview_for_name = text_preview
-            if not preview_for_name:
-                # Приоритет 1: Явный лейбл типа сообщения (например, "Gif", "Стикер")
-                label = None
-                if extra_meta and isinstance(extra_meta, dict):
-                    label = extra_meta.get("tg_title_label")  # type: ignore
-                if label:
-                    preview_for_name = _sanitize_component(str(label)[:30], max_len=40)
-            if not preview_for_name:
-                # Приоритет 2: Имя первого вложения (если есть). Для Telegram
-                # предпочитаем оригинальное имя, если передано вместе с сохранённым.
-                first_attach_display: Optional[str] = None
-                if pre_saved_attachments and len(pre_saved_attachments) > 0:
-                    display_name, saved_name = pre_saved_attachments[0]
-                    first_attach_display = display_name or saved_name  # (display_name, saved_name)
-                elif pre_saved_attachment_names and len(pre_saved_attachment_names) > 0:
-                    first_attach_display = pre_saved_attachment_names[0]
-                elif attachments and len(attachments) > 0:
-                    first_attach_display = attachments[0][0]
-                if first_attach_display:
-                    preview_for_name = _sanitize_component(first_attach_display[:30], max_len=40)
-            # Приоритет 3: Дефолт
-            if not preview_for_name:
-                preview_for_name = "Сообщение"
-            file_base = preview_for_name or "untitled"
-            filename = os.path.join(self.base_dir, f"{file_base} - {timestamp}.md")
+            candidates = _iter_telegram_title_candidates(
+                bool(tb_stripped), text_preview, extra_meta, pre_saved_attachments, pre_saved_attachment_names, attachments
+            )
+            preview_for_name = next(
+                (_sanitize_component(str(c)[:30], max_len=40) for c in candidates if c), "Сообщение"
+            )
+            note_name = f"{preview_for_name} - {timestamp}.md"
         else:
             # Для писем, если и тема пустая, и текста нет — подставляем "Письмо"
             base_subject = safe_subject or "Письмо"
             base_preview = text_preview or "Письмо"
-            filename = os.path.join(self.base_dir, f"{base_subject} - {base_preview} - {timestamp}.md")
+            note_name = f"{base_subject} - {base_preview} - {timestamp}.md"
 
-        # Заголовок (front matter)
-        date_str = datetime.now(ZoneInfo(self.timezone)).strftime("%Y-%m-%d")
-
-        md_lines: list[str] = []
-        md_lines.append("---")
-        md_lines.append("tags:")
-        if source == "telegram":
-            md_lines.append("  - \"#input/telegram\"")
-        else:
-            md_lines.append("  - \"#input/mail\"")
-        md_lines.append("Зачем_изучать?:")
-        md_lines.append(f"date: \"[[{date_str}]]\"")
-        md_lines.append("---")
-        md_lines.append("## Сообщение")
-        md_lines.append(text_body)
-        md_lines.append("")
+        # Заголовок (front matter) и текст
+        parts: list[bytes] = [
+            _MD_HEADER % (_MD_TAGS.get(source, b"mail"), date_str.encode()),
+            text_body.encode("utf-8"),
+            b"\n\n",
+        ]
 
         has_any_attachments = (
             (attachments and len(attachments) > 0)
@@ -178,35 +238,56 @@ class Storage:
         )
         if has_any_attachments:
             # Для Telegram — заголовок из ТЗ, для остального — как раньше
-            md_lines.append("## Вложение")
+            parts.append("## Вложение\n".encode("utf-8"))
             # Предварительно сохранённые файлы (например, из Telegram)
             if pre_saved_attachments:
                 for display_name, saved_name in pre_saved_attachments:
-                    link_name = saved_name or uuid.uuid4().hex
-                    md_lines.append(f"![[{link_name}]]")
+                    link_name = saved_name or self._unique_name()
+                    parts.append(f"![[{link_name}]]\n".encode("utf-8"))
             elif pre_saved_attachment_names:
                 for saved_name in pre_saved_attachment_names:
-                    link_name = saved_name or uuid.uuid4().hex
-                    md_lines.append(f"![[{link_name}]]")
+                    link_name = saved_name or self._unique_name()
+                    parts.append(f"![[{link_name}]]\n".encode("utf-8"))
+
+        # Письма сохраняются параллельно, и у них часто совпадают имена вложений (image001.png),
+        # а у уведомлений мониторинга — тема, превью и миллисекунда. Поэтому каждый файл
+        # резервируем через O_EXCL, а при ошибке удаляем всё занятое: письмо будет обработано повторно
+        reserved: list[str] = []
+        try:
             # Вложения, переданные как байты (например, из email)
-            if attachments:
-                for original_name, blob in attachments:
-                    safe_name = _slugify(original_name) if original_name else uuid.uuid4().hex
-                    attach_path = os.path.join(self.attachments_dir, safe_name)
-                    with open(attach_path, "wb") as f:
-                        f.write(blob)
-                    logger.info(f"Сохранено вложение: {attach_path}")
-                    md_lines.append(f"![[{safe_name}]]")
-            md_lines.append("")
-
-        # Заключительный блок
-        md_lines.append("---")
-        md_lines.append("## Инпуты")
-        md_lines.append(f"- [ ] Просмотреть 🔽 ⏳ {date_str}")
-
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write("\n".join(md_lines))
-        logger.info(f"Сохранено письмо (Markdown): {filename}")
+            for original_name, blob in attachments or ():
+                safe_name = (_slugify(original_name) if original_name else "") or self._unique_name()
+                reserved.append(reserve_unique_path(self.attachments_dir, safe_name))
+                parts.append(f"![[{os.path.basename(reserved[-1])}]]\n".encode("utf-8"))
+            if has_any_attachments:
+                parts.append(b"\n")
+            # Заключительный блок
+            parts.append(_MD_FOOTER % date_str.encode())
+
+            if attachments and len(attachments) > 1:
+                # Несколько вложений пишем параллельно: на write() GIL отпускается
+                futures = [
+                    self._io_pool.submit(_write_attachment, path, blob)
+                    for path, (_, blob) in zip(reserved, attachments)
+                ]
+                errors = [e for e in (f.exception() for f in futures) if e is not None]
+                if errors:
+                    raise errors[0]
+            elif attachments:
+                _write_attachment(reserved[0], attachments[0][1])
+
+            filename = reserve_unique_path(self.base_dir, note_name)
+            reserved.append(filename)
+            with open(filename, "wb") as f:
+                f.writelines(parts)
+        except BaseException:
+            for path in reserved:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            raise
+        logger.info("Сохранено письмо (Markdown): %s", filename)
 
         return filename
 